@@ -1,8 +1,17 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import time
+from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import hashlib
+import hmac
+import numbers
+import functools
+import math
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # ==========================================
@@ -12,7 +21,6 @@ CONFIG = {
     # ↓↓ Secretsから読むのでここはローカル開発用、そのままでOK
     "KEY_FILE": 'secret_key.json', 
     "SHEET_NAME": 'rock_yoko',
-    "ADMIN_PASSWORD": "rock", 
     "EVENT_TYPES": [
         "春コン", "新歓", "七夕祭", "サマコン", 
         "外ステ", "11月ライブ", "クリコン", "バレコン", "追いコン", "その他"
@@ -22,48 +30,87 @@ CONFIG = {
         "GtVo", "BaVo", "KeyVo", "Other"
     ],
     "CIRCLES": ["", "軽音楽部", "フォークソング研究会"],
-    "ROLES": ["", "部長", "会計", "PA", "ドラ管", "照明"]
+    "ROLES": ["", "部長", "会計", "PA", "ドラ管", "照明"],
+    # load_all_dataで一覧用に読み込むシート
+    "DATA_SHEETS": ["members", "bands", "performances"],
+    # 1回の追記リクエストで送るセル数の上限
+    "APPEND_CELL_LIMIT": 40000,
+    # 一覧で1ページに表示するバンド数
+    "CARDS_PER_PAGE": 25
 }
 
 # ==========================================
 # 🛠️ データベース管理クラス (Model)
 # ==========================================
+class _SheetsRetry(Retry):
+    # 書き込み (POST) は5xxや読み込みタイムアウト・切断でもサーバー側で反映済みのことがあり、
+    # 再送すると行の二重追加や別の行の削除になる。POSTは処理前に弾かれる429だけ再試行する
+    def _is_method_retryable(self, method):
+        # 読み込みエラーと5xxで再送するのはGETだけ
+        return method.upper() == "GET"
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429:
+            return bool(self.status_forcelist and 429 in self.status_forcelist)
+        return super().is_retry(method, status_code, has_retry_after)
+
 class SheetManager:
     def __init__(self):
         self.scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
         
         # クラウド対応
         if "gcp_service_account" in st.secrets:
-            key_dict = st.secrets["gcp_service_account"]
-            self.creds = ServiceAccountCredentials.from_json_keyfile_dict(key_dict, self.scope)
+            key_dict = dict(st.secrets["gcp_service_account"])
+            self.creds = Credentials.from_service_account_info(key_dict, scopes=self.scope)
         else:
-            self.creds = ServiceAccountCredentials.from_json_keyfile_name(CONFIG["KEY_FILE"], self.scope)
-            
-        self.client = gspread.authorize(self.creds)
+            self.creds = Credentials.from_service_account_file(CONFIG["KEY_FILE"], scopes=self.scope)
+
+        # 429 (クォータ超過) や5xxはHTTP層で指数バックオフして再試行する
+        # 最後まで失敗したときはレスポンスをそのまま返し、gspreadのAPIErrorにする
+        retry = _SheetsRetry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                             allowed_methods=None, raise_on_status=False)
+        session = AuthorizedSession(self.creds)
+        session.mount("https://", HTTPAdapter(max_retries=retry))
+        self.client = gspread.Client(auth=self.creds, session=session)
+        self._ws_cache = {}
 
     @st.cache_resource
     def get_workbook(_self):
         return _self.client.open(CONFIG["SHEET_NAME"])
 
+    @st.cache_resource
+    def _get_executor(_self):
+        # 書き込みは1本のスレッドで順番に処理する
+        return ThreadPoolExecutor(max_workers=1)
+
+    def _get_worksheet(self, sheet_name):
+        if sheet_name not in self._ws_cache:
+            self._ws_cache[sheet_name] = self.get_workbook().worksheet(sheet_name)
+        return self._ws_cache[sheet_name]
+
+    @st.cache_data(ttl=300, show_spinner=False)
+    def _get_header(_self, sheet_name):
+        return _self._get_worksheet(sheet_name).row_values(1)
+
     def _bool_to_str(self, val):
         return "TRUE" if val else "FALSE"
 
-    def _str_to_bool(self, val):
-        if isinstance(val, bool): return val
-        return str(val).upper() == "TRUE"
-
-    def get_next_id(self, sheet_name):
-        ws = self.get_workbook().worksheet(sheet_name)
+    def get_next_id(self, sheet_name, df=None):
+        # キャッシュには手でシートに追加した行が入っていないことがあるので、
+        # シート上のID列も必ず読み、読み込み済みのIDと合わせた最大値から採番する
+        ws = self._get_worksheet(sheet_name)
         ids = ws.col_values(1)[1:] 
         valid_ids = [int(i) for i in ids if str(i).isdigit()]
+        if df is not None and not df.empty and 'id' in df.columns:
+            valid_ids.append(int(df['id'].max()))
         return max(valid_ids) + 1 if valid_ids else 1
 
-    def add_row(self, sheet_name, data_dict):
-        ws = self.get_workbook().worksheet(sheet_name)
-        new_id = self.get_next_id(sheet_name)
+    def add_row(self, sheet_name, data_dict, df=None):
+        ws = self._get_worksheet(sheet_name)
+        new_id = self.get_next_id(sheet_name, df)
         data_dict['id'] = new_id
         
-        header = ws.row_values(1)
+        header = self._get_header(sheet_name)
         row_values = []
         for h in header:
             val = data_dict.get(h, "")
@@ -72,95 +119,277 @@ class SheetManager:
             row_values.append(val)
             
         ws.append_row(row_values)
-        self.clear_cache()
+        self.clear_cache(sheet_name)
         return new_id
 
-    def update_row(self, sheet_name, target_id, update_dict):
-        ws = self.get_workbook().worksheet(sheet_name)
+    def _to_cell(self, val):
+        if val is None or val == "":
+            return {}
+        if isinstance(val, bool):
+            return {"userEnteredValue": {"boolValue": val}}
+        if isinstance(val, numbers.Number):
+            return {"userEnteredValue": {"numberValue": val.item() if hasattr(val, "item") else val}}
+        return {"userEnteredValue": {"stringValue": str(val)}}
+
+    def append_records(self, records_by_sheet):
+        # 複数シートへの追記を1回のbatchUpdate (appendCells) にまとめる
+        # batchUpdateは全リクエストがまとめて成功/失敗するので途中状態が残らない
+        # ただしセル数が上限を超えるときだけは、上限ごとに分けて複数回送る
+        limit = CONFIG["APPEND_CELL_LIMIT"]
+        batches, requests, cells = [], [], 0
+        for sheet_name, records in records_by_sheet.items():
+            if not records: continue
+            header = self._get_header(sheet_name)
+            sheet_id = self._get_worksheet(sheet_name).id
+            chunk = max(1, limit // max(1, len(header)))
+            for i in range(0, len(records), chunk):
+                part = records[i:i + chunk]
+                n = len(part) * len(header)
+                if requests and cells + n > limit:
+                    batches.append(requests)
+                    requests, cells = [], 0
+                requests.append({"appendCells": {
+                    "sheetId": sheet_id,
+                    "rows": [{"values": [self._to_cell(r.get(h, "")) for h in header]} for r in part],
+                    "fields": "userEnteredValue",
+                }})
+                cells += n
+        if requests:
+            batches.append(requests)
+        for reqs in batches:
+            self.get_workbook().batch_update({"requests": reqs})
+        if batches:
+            self.clear_cache(*records_by_sheet)
+
+    def add_band_with_performances(self, band_dict, perf_rows, df_band=None, df_perf=None):
+        # バンドと出演情報を1回のbatchUpdateでまとめて書き込む (片方だけ残ることがない)
+        bid = self.get_next_id("bands", df_band)
+        pid = self.get_next_id("performances", df_perf)
+        band_dict['id'] = bid
+        perfs = [dict(p, id=pid + i, band_id=bid) for i, p in enumerate(perf_rows)]
+        self.append_records({"bands": [band_dict], "performances": perfs})
+        return bid
+
+    def _find_row(self, ws, target_id, row_num=None):
+        # 行番号が分かっていればその行のIDだけ確かめる (シート全体を検索しない)
+        # 他の人の追加・削除でずれていたときは従来どおり検索する
+        if row_num and ws.cell(row_num, 1).value == str(target_id):
+            return row_num
         cell = ws.find(str(target_id), in_column=1)
-        if not cell: return False
+        return cell.row if cell else None
+
+    def update_row(self, sheet_name, target_id, update_dict, row_num=None):
+        ws = self._get_worksheet(sheet_name)
+        row_num = self._find_row(ws, target_id, row_num)
+        if not row_num: return False
         
-        header = ws.row_values(1)
-        row_num = cell.row
+        header = self._get_header(sheet_name)
         
+        # 変更セルをまとめて1リクエストで書き込む
+        data = []
         for key, val in update_dict.items():
             if key in header:
                 col_num = header.index(key) + 1
                 if isinstance(val, bool):
                     val = self._bool_to_str(val)
-                ws.update_cell(row_num, col_num, val)
-                time.sleep(0.5)
+                data.append({"range": gspread.utils.rowcol_to_a1(row_num, col_num), "values": [[val]]})
+        if data:
+            ws.batch_update(data, value_input_option="USER_ENTERED")
         
-        self.clear_cache()
+        self.clear_cache(sheet_name)
         return True
 
-    def delete_row(self, sheet_name, target_id):
-        ws = self.get_workbook().worksheet(sheet_name)
-        cell = ws.find(str(target_id), in_column=1)
-        if cell:
-            ws.delete_rows(cell.row)
-            self.clear_cache()
+    def update_row_async(self, sheet_name, target_id, update_dict, row_num=None):
+        # 画面を待たせないよう、書き込みはバックグラウンドで行う
+        return self._get_executor().submit(self.update_row, sheet_name, target_id, update_dict, row_num)
+
+    def delete_row_queued(self, sheet_name, target_id, row_num=None):
+        # 保存中の更新と同じスレッドに並べて削除する (終わるまで待つ)
+        # 更新の行確認と書き込みの間に行がずれて、隣の行を上書きしないようにする
+        return self._get_executor().submit(self.delete_row, sheet_name, target_id, row_num).result()
+
+    def delete_row(self, sheet_name, target_id, row_num=None):
+        ws = self._get_worksheet(sheet_name)
+        row_num = self._find_row(ws, target_id, row_num)
+        if row_num:
+            ws.delete_rows(row_num)
+            self.clear_cache(sheet_name)
             return True
         return False
 
-    def bulk_insert_performances(self, rows_list):
-        if not rows_list: return
-        ws = self.get_workbook().worksheet("performances")
-        start_id = self.get_next_id("performances")
-        header = ws.row_values(1)
-        data = []
-        for i, r in enumerate(rows_list):
-            r['id'] = start_id + i
-            data.append([r.get(h, "") for h in header])
-        ws.append_rows(data)
-        self.clear_cache()
-
-    def clear_cache(self):
-        st.cache_data.clear()
+    def clear_cache(self, *sheet_names):
+        # 読み込み対象のシートに書き込んだときだけ、読み込みキャッシュを破棄する
+        if not sheet_names or set(sheet_names) & set(CONFIG["DATA_SHEETS"]):
+            SheetManager.load_all_data.clear()
 
-    @st.cache_data(ttl=60)
+    # 書き込み時はclear_cache()で明示的に破棄するので、TTLは長めでよい
+    @st.cache_data(ttl=3600, show_spinner=False)
     def load_all_data(_self):
-        try:
-            wb = _self.get_workbook()
-            time.sleep(1)
-            
-            raw_mem = wb.worksheet("members").get_all_records(numericise_ignore=['all'])
-            raw_band = wb.worksheet("bands").get_all_records(numericise_ignore=['all'])
-            raw_perf = wb.worksheet("performances").get_all_records(numericise_ignore=['all'])
-            
-            df_mem = pd.DataFrame(raw_mem)
-            df_band = pd.DataFrame(raw_band)
-            df_perf = pd.DataFrame(raw_perf)
-
-            def clean_df(df):
-                if df.empty: return df
-                for col in ['id', 'year', 'band_id', 'member_id']:
-                    if col in df.columns:
-                        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(int)
-                if 'is_uso' in df.columns:
-                    df['is_uso'] = df['is_uso'].apply(lambda x: _self._str_to_bool(x))
-                elif 'is_uso' not in df.columns and not df.empty:
-                    df['is_uso'] = False
-                return df
-
-            return clean_df(df_mem), clean_df(df_band), clean_df(df_perf)
-
-        except Exception as e:
-            st.error(f"データ読み込みエラー: {e}")
-            return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
-
-db = SheetManager()
+        # 失敗時は例外をそのまま投げる (空の結果をキャッシュすると1時間空のままになる)
+        wb = _self.get_workbook()
+        
+        # 3シートを1回のbatchGetでまとめて取得する
+        res = wb.values_batch_get(CONFIG["DATA_SHEETS"])
+
+        def to_df(values):
+            if not values: return pd.DataFrame()
+            header = values[0]
+            # 行末の空セルは返ってこないので列数をヘッダーに揃える
+            df = pd.DataFrame(values[1:]).reindex(columns=range(len(header))).fillna("")
+            df.columns = header
+            return df
+
+        df_mem, df_band, df_perf = (to_df(vr.get("values", [])) for vr in res["valueRanges"])
+
+        def clean_df(df):
+            if df.empty: return df
+            for col in ['id', 'year', 'band_id', 'member_id']:
+                if col in df.columns:
+                    # 年度は4桁までなのでint16で十分
+                    dtype = 'int16' if col == 'year' else int
+                    df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(dtype)
+            if 'is_uso' in df.columns:
+                df['is_uso'] = df['is_uso'].astype(str).str.strip().str.upper().eq("TRUE")
+            elif 'is_uso' not in df.columns and not df.empty:
+                df['is_uso'] = False
+            # 選択肢が決まっている列はカテゴリ型に (想定外の値もカテゴリに加えて落とさない)
+            for col, cats in [("event_type", CONFIG["EVENT_TYPES"]), ("part", CONFIG["PARTS"]),
+                              ("circle", CONFIG["CIRCLES"]), ("role", CONFIG["ROLES"])]:
+                if col in df.columns:
+                    extra = [v for v in df[col].unique() if v not in cats]
+                    df[col] = pd.Categorical(df[col], categories=cats + extra)
+            return df
+
+        return (add_derived_columns("members", clean_df(df_mem)),
+                add_derived_columns("bands", clean_df(df_band)),
+                clean_df(df_perf))
+
+# 認証・HTTPセッション・ワークシートの取得結果を再実行のたびに作り直さない
+@st.cache_resource
+def get_db():
+    return SheetManager()
+
+db = get_db()
 
 # ==========================================
 # 🎨 UIコンポーネント (Mobile Optimized)
 # ==========================================
+@functools.lru_cache(maxsize=256)
 def format_year(year_int):
-    if year_int == 0: return "全年度"
-    try:
-        s = str(int(year_int))
-        return s[-2:] if len(s) >= 2 else s
-    except:
-        return "00"
+    y = int(year_int) if year_int else 0
+    return "全年度" if y == 0 else f"{y % 100:02d}"
+
+def format_year_series(year_s):
+    """format_yearの列版 (行ごとにPython関数を呼ばない)"""
+    y = pd.to_numeric(year_s, errors='coerce').fillna(0).astype(int)
+    return pd.Series(np.where(y == 0, "全年度", (y % 100).astype(str).str.zfill(2)), index=y.index)
+
+def make_label(year_str_s, name_s, part_s=None):
+    """「年度+名前(パート)」のラベルを列単位でまとめて作る (年度は表示用に整形済みの列)"""
+    label = year_str_s.astype(str).str.cat(name_s.astype(str))
+    if part_s is not None:
+        label = label.str.cat(part_s.astype(str), sep="(") + ")"
+    return label
+
+def flash(msg, kind="success"):
+    """st.rerun()の後に表示するメッセージを予約する"""
+    st.session_state.flash = (kind, msg)
+
+def show_flash():
+    if "flash" in st.session_state:
+        kind, msg = st.session_state.pop("flash")
+        getattr(st, kind)(msg)
+
+def add_derived_columns(sheet_name, df):
+    """表示・絞り込み用の補助列を作る (読み込み時に一度だけ)"""
+    if df.empty: return df
+    if 'year' in df.columns:
+        # 表示用の年度 ("24" / "全年度")
+        df['year_str'] = format_year_series(df['year'])
+    if sheet_name == "bands":
+        # キーワード検索用: アーティスト・曲名・コメントを小文字で1列に連結
+        df['_search'] = (df['artist_name'].astype(str) + "\x1f" + df['song_name'].astype(str)
+                         + "\x1f" + df['description'].astype(str)).str.lower()
+    elif sheet_name == "members" and 'sub_parts' in df.columns:
+        # "Gt,Key" 形式のサブパートをパートの集合に分解しておく (部分一致の誤判定を防ぐ)
+        df['sub_parts_set'] = df['sub_parts'].astype(str).str.split(',').map(
+            lambda xs: frozenset(x.strip() for x in xs if x.strip()))
+    return df
+
+# --- ⏳ 書き込み中の更新 ---
+def queue_update(sheet_name, target_id, update_dict, row_num=None):
+    """更新をバックグラウンドに投げ、完了までは画面側で先に反映しておく"""
+    fut = db.update_row_async(sheet_name, target_id, update_dict, row_num)
+    st.session_state.setdefault("pending_writes", []).append((fut, sheet_name, target_id, update_dict))
+
+def collect_pending_writes():
+    """まだ終わっていない更新を返す (終わったものは結果を表示して取り除く)"""
+    # update_rowの中のキャッシュ破棄は、同時に走っていた読み込み (書き込み前の内容) に
+    # 上書きされることがある。完了を確認したここで改めて破棄してから読み込む
+    pending, done_sheets = [], set()
+    for w in st.session_state.get("pending_writes", []):
+        fut = w[0]
+        if not fut.done():
+            pending.append(w)
+            continue
+        done_sheets.add(w[1])
+        if fut.exception():
+            st.error(f"更新の保存に失敗しました: {fut.exception()}")
+        elif not fut.result():
+            st.error("更新対象が見つかりませんでした")
+        else:
+            st.toast("更新を保存しました")
+    if done_sheets:
+        db.clear_cache(*done_sheets)
+    st.session_state.pending_writes = pending
+    return pending
+
+def apply_pending_writes(pending, frames):
+    for _, sheet_name, target_id, update_dict in pending:
+        df = frames.get(sheet_name)
+        if df is None or df.empty: continue
+        mask = df['id'] == target_id
+        for key, val in update_dict.items():
+            if key in df.columns:
+                df.loc[mask, key] = val
+    for sheet_name, df in frames.items():
+        if any(w[1] == sheet_name for w in pending):
+            add_derived_columns(sheet_name, df)
+    if pending:
+        st.caption(f"⏳ {len(pending)}件の更新を保存中です")
+
+# --- 🔗 データ結合 ---
+@st.cache_data(ttl=60)
+def build_band_list(df_mem, df_band, df_perf):
+    """バンドごとに1行の一覧用データと、絞り込み用の逆引き表を返す (元データが同じなら再計算しない)"""
+    if df_band.empty or df_perf.empty or df_mem.empty:
+        return pd.DataFrame(), {}
+    # 出演に部員情報を付ける (部員はIDをインデックスにして member_id から引く)
+    # 一覧で使う列だけを取り出して結合し、全列のコピーを作らない
+    # 名前が重なるのは出演のpartだけなので、renameせずに部員側を part_m にする
+    mem = df_mem[['id', 'year_str', 'name', 'part', 'circle', 'sub_parts_set']].set_index('id')
+    perf = df_perf[['band_id', 'member_id', 'part']].join(mem, on='member_id', rsuffix='_m')
+    
+    # 欠損埋め (partはカテゴリ型で、出演行には必ず値があるので対象外)
+    perf.fillna({"name": "不明", "year_str": "全年度"}, inplace=True)
+    # 表示名
+    perf['mem_disp'] = make_label(perf['year_str'], perf['name'], perf['part'])
+
+    # バンドごとにメンバーの表示名をまとめる (出演のないバンドは載せない)
+    mem_disp = perf.groupby('band_id', sort=False)['mem_disp'].agg(", ".join)
+    bands = df_band.join(mem_disp, on='id', how='inner').sort_values(['year', 'id'], ascending=[False, False])
+
+    # パート・所属 → バンドID の逆引き
+    def index_by(df, col):
+        return df.groupby(col, observed=True)['band_id'].agg(lambda s: frozenset(s.tolist())).to_dict()
+    subs = perf[['band_id', 'sub_parts_set']].explode('sub_parts_set')
+    band_index = {
+        "part": index_by(perf, 'part'),
+        "part_m": index_by(perf, 'part_m'),
+        "sub_parts": index_by(subs, 'sub_parts_set'),
+        "circle": index_by(perf, 'circle'),
+    }
+    return bands, band_index
 
 # --- 📱 カード型リスト表示 ---
 def render_band_cards(grouped_df):
@@ -169,49 +398,49 @@ def render_band_cards(grouped_df):
         st.warning("条件に一致するバンドはありません")
         return
 
-    # スタイルの調整
-    st.markdown("""
-    <style>
-    .band-card {
-        background-color: #f0f2f6;
-        padding: 15px;
-        border-radius: 10px;
-        margin-bottom: 15px;
-        border-left: 5px solid #ff4b4b;
-    }
-    .dark-mode .band-card {
-        background-color: #262730;
-    }
-    .band-title { font-weight: bold; font-size: 1.1em; color: #31333F; }
-    .song-title { color: #555; font-style: italic; }
-    .event-tag { 
-        background-color: #ff4b4b; color: white; 
-        padding: 2px 8px; border-radius: 4px; font-size: 0.8em;
-    }
-    </style>
-    """, unsafe_allow_html=True)
+    # 全件は描画せず、今のページの分だけカードを作る
+    page_size = CONFIG["CARDS_PER_PAGE"]
+    total_pages = math.ceil(len(grouped_df) / page_size)
+    page = min(st.session_state.get('card_page', 0), total_pages - 1)
+    page_df = grouped_df.iloc[page * page_size:(page + 1) * page_size]
 
-    for _, row in grouped_df.iterrows():
+    cols = ['artist_name', 'song_name', 'year', 'event_type', 'mem_disp', 'description']
+    for artist, song, year, ev, mem_disp, desc in page_df[cols].itertuples(index=False, name=None):
         # Streamlitのコンテナ機能を使って枠を作る
         with st.container(border=True):
             # 1行目：アーティスト - 曲名
-            st.markdown(f"### **{row['artist_name']}** / {row['song_name']}")
+            st.markdown(f"### **{artist}** / {song}")
             
             # 2行目：イベント情報
-            yr = format_year(row['year_b'])
-            ev = row['event_type']
+            yr = format_year(year)
             st.caption(f"📅 {yr}年度 {ev}")
             
             # 3行目：メンバー
-            st.write(f"👥 {row['mem_disp']}")
+            st.write(f"👥 {mem_disp}")
             
             # 4行目：コメント（あれば）
-            if row['description']:
+            if desc:
                 with st.expander("💬 コメントを見る"):
-                    st.write(row['description'])
+                    st.write(desc)
+
+    # ページ送り
+    if total_pages > 1:
+        c1, c2, c3 = st.columns([1, 2, 1])
+        c1.button("◀ 前へ", key="card_prev", disabled=page == 0,
+                  on_click=lambda: st.session_state.update(card_page=page - 1))
+        c2.caption(f"{page + 1} / {total_pages} ページ")
+        c3.button("次へ ▶", key="card_next", disabled=page >= total_pages - 1,
+                  on_click=lambda: st.session_state.update(card_page=page + 1))
+
+@st.cache_data(ttl=60)
+def member_options(df_mem):
+    """部員選択肢 (ラベル→ID) と ID→メインパート の対応表"""
+    ids = df_mem['id'].tolist()
+    labels = make_label(df_mem['year_str'], df_mem['name']).tolist()
+    return dict(zip(labels, ids)), dict(zip(ids, df_mem['part'].astype(str).tolist()))
 
 # --- 📱 登録フォーム ---
-def render_register_tab(df_mem):
+def render_register_tab(df_mem, df_band, df_perf):
     st.subheader("📝 新規登録")
     
     # 登録対象の切り替え
@@ -235,9 +464,7 @@ def render_register_tab(df_mem):
         if 'temp_mems' not in st.session_state: st.session_state.temp_mems = []
 
         if not df_mem.empty:
-            df_mem['opt_label'] = df_mem.apply(lambda x: f"{format_year(x['year'])}{x['name']}", axis=1)
-            mem_dict = dict(zip(df_mem['opt_label'], df_mem['id']))
-            default_parts = dict(zip(df_mem['id'], df_mem['part']))
+            mem_dict, default_parts = member_options(df_mem)
 
             # スマホ向けに縦並びにする
             sel_label = st.selectbox("部員検索", list(mem_dict.keys()), key="reg_sb_mem")
@@ -273,16 +500,14 @@ def render_register_tab(df_mem):
                         st.error("アーティスト名は必須です")
                     else:
                         with st.spinner("保存中..."):
-                            bid = db.add_row("bands", {
+                            db.add_band_with_performances({
                                 "year": r_year, "event_type": r_event, "band_name": "",
                                 "artist_name": r_artist, "song_name": r_song, "description": r_desc,
                                 "is_uso": is_uso
-                            })
-                            perfs = [{"band_id": bid, "member_id": m['id'], "part": m['part']} for m in st.session_state.temp_mems]
-                            db.bulk_insert_performances(perfs)
-                        st.success(f"保存しました！")
+                            }, [{"member_id": m['id'], "part": m['part']} for m in st.session_state.temp_mems],
+                            df_band, df_perf)
+                        flash("保存しました！")
                         st.session_state.temp_mems = []
-                        time.sleep(1)
                         st.rerun()
 
     else: # 部員登録
@@ -305,37 +530,59 @@ def render_register_tab(df_mem):
                         "name": name, "year": year, "part": part, 
                         "sub_parts": ",".join(sub), "circle": circle, "role": role,
                         "is_uso": is_uso
-                    })
-                st.success(f"登録しました: {name}")
-                time.sleep(1)
+                    }, df_mem)
+                flash(f"登録しました: {name}")
                 st.rerun()
 
 # --- 📱 管理・修正フォーム ---
 def render_admin_tab(df_mem, df_band):
     st.subheader("🔧 管理者メニュー")
-    password = st.text_input("合言葉 (パスワード)", type="password")
-    
-    if password != CONFIG["ADMIN_PASSWORD"]:
-        if password: st.error("合言葉が違います")
-        return
-
-    st.success("認証成功")
+    # 認証済みかどうかはセッションに覚えておき、入力のたびに照合し直さない
+    if not st.session_state.get("admin_ok"):
+        # 合言葉はSecretsの admin_pw_sha256 (SHA-256) だけを使う
+        # 未設定のときは既定の合言葉で通さず、ログインできないようにする
+        # (ローカル開発でも .streamlit/secrets.toml に設定する)
+        if "admin_pw_sha256" not in st.secrets:
+            st.error("合言葉が設定されていません (Secretsに admin_pw_sha256 を設定してください)")
+            return
+        with st.form("admin_login"):
+            password = st.text_input("合言葉 (パスワード)", type="password")
+            if st.form_submit_button("認証"):
+                expected = st.secrets["admin_pw_sha256"]
+                digest = hashlib.sha256(password.encode()).hexdigest()
+                st.session_state.admin_ok = hmac.compare_digest(digest, expected)
+                if not st.session_state.admin_ok: st.error("合言葉が違います")
+        if not st.session_state.get("admin_ok"):
+            return
+
+    c1, c2 = st.columns([3, 1])
+    c1.success("認証成功")
+    if c2.button("ログアウト"):
+        st.session_state.admin_ok = False
+        st.rerun()
     target = st.selectbox("修正対象", ["バンド修正", "部員修正"])
 
     if target == "部員修正":
         if df_mem.empty: return
         df_mem_sort = df_mem.sort_values(['year', 'id'], ascending=False)
-        opts = {f"{format_year(r['year'])} {r['name']}": r for _, r in df_mem_sort.iterrows()}
+        # 選択肢はIDにし、選んだIDを覚えておく
+        # (編集で並び順や表示名が変わり選択欄が作り直されても、同じ部員を指したままにする)
+        ids = df_mem_sort['id'].tolist()
+        labels = dict(zip(ids, (df_mem_sort['year_str'] + " " + df_mem_sort['name'].astype(str)).tolist()))
+        prev = st.session_state.get("edit_mem_id")
         
-        sel_key = st.selectbox("修正する部員を選択", list(opts.keys()))
-        if sel_key:
-            tgt = opts[sel_key]
+        sel_id = st.selectbox("修正する部員を選択", ids, index=ids.index(prev) if prev in labels else 0,
+                              format_func=labels.get)
+        st.session_state.edit_mem_id = sel_id
+        if sel_id is not None:
+            tgt = df_mem_sort.loc[df_mem_sort['id'] == sel_id].iloc[0]
+            row_num = int(tgt.name) + 2  # 読み込み時の行順 + ヘッダー行
             suffix = f"_{tgt['id']}"
             
             with st.form(f"edit_mem_{suffix}"):
                 is_uso = st.checkbox("嘘フラグ", value=tgt.get('is_uso', False))
                 name = st.text_input("名前", value=tgt['name'])
-                year = st.number_input("年度", value=tgt['year'])
+                year = st.number_input("年度", value=int(tgt['year']))
                 part = st.selectbox("Main", CONFIG["PARTS"], index=CONFIG["PARTS"].index(tgt['part']) if tgt['part'] in CONFIG["PARTS"] else 0)
                 
                 defs = [x for x in str(tgt['sub_parts']).split(',') if x in CONFIG["PARTS"]]
@@ -347,32 +594,35 @@ def render_admin_tab(df_mem, df_band):
                 up_btn = st.form_submit_button("更新する", type="primary")
                 
                 if up_btn:
-                    db.update_row("members", tgt['id'], {
+                    queue_update("members", tgt['id'], {
                         "name": name, "year": year, "part": part, 
                         "sub_parts": ",".join(sub), "circle": circle, 
                         "is_uso": is_uso
-                    })
-                    st.success("更新しました")
-                    time.sleep(1)
+                    }, row_num)
+                    flash("更新を保存中です (完了するまで少し時間がかかります)", "info")
                     st.rerun()
             
             if st.button("この部員を削除", key=f"del_m_{suffix}"):
-                db.delete_row("members", tgt['id'])
-                st.warning("削除しました")
-                time.sleep(1)
+                if db.delete_row_queued("members", tgt['id'], row_num):
+                    flash("削除しました", "warning")
+                else:
+                    flash("削除対象が見つかりませんでした", "error")
                 st.rerun()
 
     else: # バンド修正
         if df_band.empty: return
         # 検索しやすいようにリスト化
-        b_map = {}
-        for _, r in df_band.iterrows():
-            label = f"[{format_year(r['year'])}{r['event_type']}] {r['artist_name']} / {r['song_name']}"
-            b_map[label] = r
+        b_ids = df_band['id'].tolist()
+        b_labels = dict(zip(b_ids, ("[" + df_band['year_str'] + df_band['event_type'].astype(str) + "] "
+                                    + df_band['artist_name'].astype(str) + " / " + df_band['song_name'].astype(str)).tolist()))
+        prev = st.session_state.get("edit_band_id")
             
-        sel_bk = st.selectbox("修正するバンドを選択", list(b_map.keys()))
-        if sel_bk:
-            btgt = b_map[sel_bk]
+        sel_bid = st.selectbox("修正するバンドを選択", b_ids, index=b_ids.index(prev) if prev in b_labels else 0,
+                               format_func=b_labels.get)
+        st.session_state.edit_band_id = sel_bid
+        if sel_bid is not None:
+            btgt = df_band.loc[df_band['id'] == sel_bid].iloc[0]
+            row_num = int(btgt.name) + 2  # 読み込み時の行順 + ヘッダー行
             suffix = f"_{btgt['id']}"
             
             with st.form(f"edit_band_{suffix}"):
@@ -384,18 +634,18 @@ def render_admin_tab(df_mem, df_band):
                 up_btn = st.form_submit_button("更新する", type="primary")
                 
                 if up_btn:
-                    db.update_row("bands", btgt['id'], {
+                    queue_update("bands", btgt['id'], {
                         "artist_name": art, "song_name": song, "description": desc,
                         "is_uso": is_uso
-                    })
-                    st.success("更新しました")
-                    time.sleep(1)
+                    }, row_num)
+                    flash("更新を保存中です (完了するまで少し時間がかかります)", "info")
                     st.rerun()
 
             if st.button("このバンドを削除", key=f"del_b_{suffix}"):
-                db.delete_row("bands", btgt['id'])
-                st.warning("削除しました")
-                time.sleep(1)
+                if db.delete_row_queued("bands", btgt['id'], row_num):
+                    flash("削除しました", "warning")
+                else:
+                    flash("削除対象が見つかりませんでした", "error")
                 st.rerun()
 
 # ==========================================
@@ -405,24 +655,20 @@ def main():
     st.set_page_config(page_title="ロック研DB", layout="centered", initial_sidebar_state="collapsed")
     
     st.markdown("### 🎸 ロック研データベース")
+    show_flash()
     
-    # データロード
-    df_mem, df_band, df_perf = db.load_all_data()
-
-    # データ結合処理
-    df_full = pd.DataFrame()
-    if not df_band.empty and not df_perf.empty and not df_mem.empty:
-        mem_ren = df_mem.rename(columns={'year':'year_m', 'name':'name_m', 'part':'part_m', 'sub_parts':'sub_parts_m', 'is_uso':'is_uso_m'})
-        band_ren = df_band.rename(columns={'year':'year_b', 'id':'band_id_key', 'is_uso':'is_uso_b'})
-        
-        df_full = pd.merge(df_perf, mem_ren, left_on='member_id', right_on='id', how='left')
-        df_full = pd.merge(df_full, band_ren, left_on='band_id', right_on='band_id_key', how='left')
-        
-        # 欠損埋め
-        df_full.fillna({"name_m": "不明", "part": "?", "artist_name": "不明", "song_name": "不明", "description": ""}, inplace=True)
-        # 表示名
-        df_full['year_str'] = df_full['year_m'].fillna(0).astype(int).apply(format_year)
-        df_full['mem_disp'] = df_full['year_str'].astype(str) + df_full['name_m'].astype(str) + "(" + df_full['part'].astype(str) + ")"
+    # 他の人の更新を取り込みたいとき用
+    if st.sidebar.button("🔄 最新データを再読込"):
+        st.cache_data.clear()
+
+    # データロード (保存中の更新は読み込んだデータに上書きしておく)
+    pending = collect_pending_writes()
+    try:
+        df_mem, df_band, df_perf = db.load_all_data()
+    except Exception as e:
+        st.error(f"データ読み込みエラー: {e}")
+        df_mem, df_band, df_perf = pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+    apply_pending_writes(pending, {"members": df_mem, "bands": df_band})
 
     # --- 📱 タブ構成に変更 ---
     tab_list, tab_reg, tab_admin = st.tabs(["🎵 リスト", "📝 登録", "🔧 管理"])
@@ -432,50 +678,52 @@ def main():
     # -----------------------
     with tab_list:
         # 検索フィルターはアコーディオンに隠す
+        # フォームにまとめて、入力のたびではなく「検索」を押したときだけ再実行する
+        # (未送信の間はフォーム内の値が前回送信時のまま返ってくる)
         with st.expander("🔍 検索・絞り込み条件"):
-            f_uso = st.checkbox("嘘バンも含める", value=False)
-            f_kw = st.text_input("キーワード検索", placeholder="曲名・アーティスト・コメント")
-            
-            c1, c2 = st.columns(2)
-            f_year = c1.selectbox("年度", [0] + list(range(2020, 2030)), format_func=lambda x: f"{format_year(x)}年度")
-            f_event = c2.selectbox("イベント", ["すべて"] + CONFIG["EVENT_TYPES"])
-            
-            c3, c4 = st.columns(2)
-            f_part = c3.selectbox("パート", ["すべて"] + CONFIG["PARTS"])
-            f_circle = c4.selectbox("所属", ["すべて"] + CONFIG["CIRCLES"])
+            with st.form("filter_form"):
+                f_uso = st.checkbox("嘘バンも含める", value=False)
+                f_kw = st.text_input("キーワード検索", placeholder="曲名・アーティスト・コメント")
+                
+                c1, c2 = st.columns(2)
+                f_year = c1.selectbox("年度", [0] + list(range(2020, 2030)), format_func=lambda x: f"{format_year(x)}年度")
+                f_event = c2.selectbox("イベント", ["すべて"] + CONFIG["EVENT_TYPES"])
+                
+                c3, c4 = st.columns(2)
+                f_part = c3.selectbox("パート", ["すべて"] + CONFIG["PARTS"])
+                f_circle = c4.selectbox("所属", ["すべて"] + CONFIG["CIRCLES"])
+
+                # 条件を変えたら1ページ目から
+                if st.form_submit_button("検索", use_container_width=True):
+                    st.session_state.card_page = 0
 
-        if df_full.empty:
+        # 一覧はバンド単位にまとめたものを元データごとに一度だけ作り、ここでは絞り込むだけ
+        bands, band_index = build_band_list(df_mem, df_band, df_perf)
+        if bands.empty:
             st.info("データがありません")
         else:
-            view_df = df_full.copy()
-            # フィルタリング
-            if not f_uso:
-                if 'is_uso_b' in view_df.columns: view_df = view_df[view_df['is_uso_b'] != True]
-            if f_year > 0: view_df = view_df[view_df['year_b'] == f_year]
+            view_df = bands
+            if not f_uso: view_df = view_df[~view_df['is_uso']]
+            if f_year > 0: view_df = view_df[view_df['year'] == f_year]
             if f_event != "すべて": view_df = view_df[view_df['event_type'] == f_event]
-            if f_kw:
-                mask = view_df[['artist_name', 'song_name', 'description']].astype(str).apply(lambda x: x.str.contains(f_kw, na=False)).any(axis=1)
-                view_df = view_df[mask]
-            
-            # 部員絞り込み
+            if f_kw: view_df = view_df[view_df['_search'].str.contains(f_kw.lower(), regex=False)]
+
+            # 部員絞り込み (バンド内の誰かが該当すればバンドごと残す)
+            # 条件ごとのバンドIDを先に積集合にして、行の絞り込みは1回で済ませる
+            keep_ids = None
             if f_part != "すべて":
-                t_ids = view_df[
-                    (view_df['part_m'] == f_part) | 
-                    (view_df['sub_parts_m'].astype(str).str.contains(f_part, na=False)) |
-                    (view_df['part'] == f_part)
-                ]['band_id'].unique()
-                view_df = view_df[view_df['band_id'].isin(t_ids)]
+                keep_ids = (band_index["part"].get(f_part, frozenset())
+                            | band_index["part_m"].get(f_part, frozenset())
+                            | band_index["sub_parts"].get(f_part, frozenset()))
             if f_circle != "すべて":
-                t_ids_c = view_df[view_df['circle'] == (f_circle if f_circle else "")]['band_id'].unique()
-                view_df = view_df[view_df['band_id'].isin(t_ids_c)]
+                c_ids = band_index["circle"].get(f_circle, frozenset())
+                keep_ids = c_ids if keep_ids is None else keep_ids & c_ids
+            if keep_ids is not None:
+                view_df = view_df[view_df['id'].isin(keep_ids)]
 
-            # グルーピングして表示
             if not view_df.empty:
-                grouped = view_df.groupby(['band_id', 'year_b', 'event_type', 'artist_name', 'song_name', 'description'])['mem_disp'].apply(lambda x: ", ".join(x.astype(str))).reset_index()
-                grouped = grouped.sort_values(['year_b', 'band_id'], ascending=[False, False])
-                
-                st.caption(f"{len(grouped)}件のバンドが見つかりました")
-                render_band_cards(grouped)
+                st.caption(f"{len(view_df)}件のバンドが見つかりました")
+                render_band_cards(view_df)
             else:
                 st.warning("条件に一致するバンドはありません")
 
@@ -483,7 +731,7 @@ def main():
     # 2. 登録タブ
     # -----------------------
     with tab_reg:
-        render_register_tab(df_mem)
+        render_register_tab(df_mem, df_band, df_perf)
 
     # -----------------------
     # 3. 管理タブ